@@ -15,13 +15,23 @@ KiCad 9.x 专用，完整功能版
 - FreeRouting 自动布线 (异步支持)
 """
 
+import asyncio
 import json
+import logging
 import sys
 import os
+import queue
 import subprocess
 import base64
-import glob
+import fcntl
+import hashlib
 import shutil
+import signal
+import threading
+import time
+import types
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
 PROJECTS_BASE = "/root/pcb/projects"
@@ -29,6 +39,24 @@ KICAD_CLI = "kicad-cli"
 FREEROUTING_JAR = "/opt/freerouting.jar"
 JAVA_CMD = "java"
 
+# 启动时探测一次，服务运行期间不再重复 stat
+FREEROUTING_AVAILABLE = os.path.exists(FREEROUTING_JAR)
+
+# kicad-cli 子命令前缀
+CMD_PCB_DRC = (KICAD_CLI, "pcb", "drc")
+CMD_GERBERS = (KICAD_CLI, "pcb", "export", "gerbers")
+CMD_DRILL = (KICAD_CLI, "pcb", "export", "drill")
+CMD_POS = (KICAD_CLI, "pcb", "export", "pos")
+CMD_PCB_SVG = (KICAD_CLI, "pcb", "export", "svg")
+CMD_PCB_PDF = (KICAD_CLI, "pcb", "export", "pdf")
+CMD_STEP = (KICAD_CLI, "pcb", "export", "step")
+CMD_RENDER = (KICAD_CLI, "pcb", "render")
+CMD_SCH_ERC = (KICAD_CLI, "sch", "erc")
+CMD_BOM = (KICAD_CLI, "sch", "export", "bom")
+CMD_NETLIST = (KICAD_CLI, "sch", "export", "netlist")
+CMD_SCH_PDF = (KICAD_CLI, "sch", "export", "pdf")
+CMD_SCH_SVG = (KICAD_CLI, "sch", "export", "svg")
+
 # KiCad Python API
 try:
     import pcbnew
@@ -36,31 +64,336 @@ try:
 except ImportError:
     HAS_PCBNEW = False
 
-def log(msg):
-    print(f"[MCP] {msg}", file=sys.stderr)
+# 流式 JSON 解析 (可选，用于大型 DRC/ERC 报告)
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+# 更快的 JSON 编解码 (可选)
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# 预编译的参数校验 (可选，缺失时使用内置的简易校验)
+try:
+    import fastjsonschema
+    HAS_FASTJSONSCHEMA = True
+except ImportError:
+    HAS_FASTJSONSCHEMA = False
+
+# 文件系统事件监听 (可选，用于免 stat 的项目目录缓存)
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    HAS_WATCHDOG = True
+except ImportError:
+    HAS_WATCHDOG = False
+
+def json_loads(data):
+    """解析 JSON (str 或 bytes)，有 orjson 时使用 orjson"""
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_bytes(obj):
+    """序列化为紧凑的 UTF-8 JSON 字节"""
+    if HAS_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+# 日志输出到 stderr (stdout 是 MCP 协议通道)，格式在 main 中配置
+logger = logging.getLogger("kicad-mcp")
+LOG_LEVEL = os.environ.get("KICAD_MCP_LOG_LEVEL", "INFO").upper()
 
-def run_cmd(cmd, cwd=None, use_xvfb=False):
+def run_cmd(cmd, cwd=None, use_xvfb=False, capture=True):
+    """capture=False 时丢弃 stdout，只保留 stderr 用于报错"""
     if use_xvfb:
         cmd = ["xvfb-run", "-a"] + cmd
-    log(f"执行: {' '.join(cmd)}")
+    logger.debug("执行: %s", " ".join(cmd))
     try:
-        r = subprocess.run(cmd, capture_output=True, text=True, cwd=cwd, timeout=300)
-        return {"success": r.returncode == 0, "stdout": r.stdout, "stderr": r.stderr}
+        r = subprocess.run(
+            cmd, stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+            stderr=subprocess.PIPE, cwd=cwd, timeout=300
+        )
+        return {"success": r.returncode == 0, "stdout": r.stdout or b"", "stderr": r.stderr}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+def cmd_error(r):
+    """命令失败原因；输出以字节保存，只在需要报错时解码"""
+    if "error" in r:
+        return r["error"]
+    return r.get("stderr", b"").decode(errors="replace")
+
+async def run_cmd_async(cmd, cwd=None, use_xvfb=False, xvfb_num=None, capture=True):
+    """run_cmd 的协程版本，多个导出可并发执行"""
+    if use_xvfb:
+        # 并发的 xvfb-run -a 从同一显示号开始探测会冲突，错开起点
+        cmd = ["xvfb-run", "-a"] + (["-n", str(xvfb_num)] if xvfb_num else []) + cmd
+    logger.debug("执行: %s", " ".join(cmd))
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE, cwd=cwd
+        )
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout=300)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return {"success": False, "error": f"命令超时: {cmd[0]}"}
+        return {"success": proc.returncode == 0, "stdout": out or b"", "stderr": err}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+def read_violations(path, keys=("violations",), limit=10):
+    """统计报告中的违规数并取前 limit 条
+
+    keys 按顺序取第一个存在的顶层数组。有 ijson 时流式解析，
+    只保留前 limit 条，不把整个报告载入内存。
+    """
+    if not HAS_IJSON:
+        with open(path, 'rb') as f:
+            data = json_loads(f.read())
+        v = next((data[k] for k in keys if k in data), [])
+        return (len(v), v[:limit]) if isinstance(v, list) else (0, [])
+    
+    items = {f"{k}.item": k for k in keys}
+    found = {}
+    builder = None
+    with open(path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f):
+            if builder is not None:
+                # 正在构建一条样本，直到它的结束事件
+                builder.event(event, value)
+                if event in ("start_map", "start_array"):
+                    depth += 1
+                elif event in ("end_map", "end_array"):
+                    depth -= 1
+                    if depth == 0:
+                        sample.append(builder.value)
+                        builder = None
+                continue
+            key = items.get(prefix)
+            if key is None:
+                if event == "start_array" and prefix in keys:
+                    found[prefix] = [0, []]
+                continue
+            if event in ("map_key", "end_map", "end_array"):
+                continue
+            found[key][0] += 1
+            sample = found[key][1]
+            if len(sample) < limit:
+                if event in ("start_map", "start_array"):
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                    depth = 1
+                else:
+                    sample.append(value)
+    
+    for k in keys:
+        if k in found:
+            return found[k][0], found[k][1]
+    return 0, []
+
+# 项目目录缓存: 目录 -> (mtime_ns, {"pcb", "sch"})
+# 目录增删文件会更新其 mtime，mtime 不变时直接复用上次扫描结果。
+# 有 watchdog 时由文件事件负责失效，命中缓存不再 stat。
+_PROJECT_CACHE = {}
+_PROJECT_WATCH = {"observer": None, "generation": 0}
+
+# list_projects 结果缓存: [过期时间, 结果]
+LIST_PROJECTS_TTL = 5
+_LIST_PROJECTS_CACHE = [0.0, None]
+
+def scan_project(d):
+    """单次 scandir 同时找出 PCB 和原理图"""
+    cached = _PROJECT_CACHE.get(d)
+    if cached and _PROJECT_WATCH["observer"]:
+        return cached[1]
+    
+    generation = _PROJECT_WATCH["generation"]
+    try:
+        mtime = os.stat(d).st_mtime_ns
+    except OSError:
+        _PROJECT_CACHE.pop(d, None)
+        return {"pcb": None, "sch": None}
+    
+    if cached and cached[0] == mtime:
+        return cached[1]
+    
+    info = {"pcb": None, "sch": None}
+    with os.scandir(d) as it:
+        for e in it:
+            if e.name.startswith('.'):
+                continue
+            if info["pcb"] is None and e.name.endswith(".kicad_pcb"):
+                info["pcb"] = e.path
+            elif info["sch"] is None and e.name.endswith(".kicad_sch"):
+                info["sch"] = e.path
+    # 扫描期间有文件事件时不写缓存，避免存入过期结果
+    if generation == _PROJECT_WATCH["generation"]:
+        _PROJECT_CACHE[d] = (mtime, info)
+    return info
+
+if HAS_WATCHDOG:
+    class ProjectEventHandler(FileSystemEventHandler):
+        """项目目录或其顶层文件变化时使对应缓存失效"""
+        
+        def on_any_event(self, event):
+            if event.event_type in ("opened", "closed", "closed_no_write"):
+                return
+            for path in (event.src_path, getattr(event, "dest_path", "")):
+                if not path:
+                    continue
+                parent = os.path.dirname(path)
+                if parent == PROJECTS_BASE:
+                    self.invalidate(path)
+                elif os.path.dirname(parent) == PROJECTS_BASE:
+                    self.invalidate(parent)
+        
+        def invalidate(self, d):
+            _PROJECT_WATCH["generation"] += 1
+            _PROJECT_CACHE.pop(d, None)
+            _DIRS_INITED.discard(d)
+            _LIST_PROJECTS_CACHE[1] = None
+
+def watch_projects():
+    """启动时扫描一次所有项目，并用 watchdog 维护缓存"""
+    if not HAS_WATCHDOG or not os.path.isdir(PROJECTS_BASE):
+        return False
+    observer = Observer()
+    observer.schedule(ProjectEventHandler(), PROJECTS_BASE, recursive=True)
+    observer.daemon = True
+    observer.start()
+    with os.scandir(PROJECTS_BASE) as it:
+        for e in it:
+            if e.is_dir() and not e.name.startswith('.'):
+                scan_project(e.path)
+    _PROJECT_WATCH["observer"] = observer
+    return True
+
 def find_pcb(d):
-    f = glob.glob(os.path.join(d, "*.kicad_pcb"))
-    return f[0] if f else None
+    return scan_project(d)["pcb"]
 
 def find_sch(d):
-    f = glob.glob(os.path.join(d, "*.kicad_sch"))
-    return f[0] if f else None
+    return scan_project(d)["sch"]
+
+def iter_files(d):
+    """递归列出目录下的文件 (DirEntry)，不跟随目录软链接"""
+    with os.scandir(d) as it:
+        entries = list(it)
+    for e in entries:
+        if e.is_dir():
+            if not e.is_symlink():
+                yield from iter_files(e.path)
+        else:
+            yield e
+
+# 本进程中已创建过输出目录的项目
+_DIRS_INITED = set()
 
 def ensure_dirs(d):
+    if d in _DIRS_INITED:
+        return
     for x in ["output/gerber", "output/bom", "output/3d", "output/reports", 
               "output/jlcpcb", "output/docs", "output/images", "output/netlist"]:
         os.makedirs(os.path.join(d, x), exist_ok=True)
+    _DIRS_INITED.add(d)
+
+# PCB 板子缓存: pcb 路径 -> [(mtime_ns, size), BOARD, 统计信息]
+# LoadBoard 要解析整个 s-expression 文件，同一项目连续调用多个工具时复用。
+# 统计信息 (尺寸/元件/过孔等) 首次查询时计算，随板子一起失效。
+BOARD_CACHE_SIZE = 8
+_BOARD_CACHE = OrderedDict()
+
+# KiCad 内部单位为纳米
+IU_PER_MM = 1000000.0
+
+# pcbnew 不是线程安全的，使用缓存板子的操作都要持有此锁
+PCBNEW_LOCK = threading.RLock()
+
+def board_entry(pcb_file):
+    st = os.stat(pcb_file)
+    key = (st.st_mtime_ns, st.st_size)
+    with PCBNEW_LOCK:
+        cached = _BOARD_CACHE.get(pcb_file)
+        if cached and cached[0] == key:
+            _BOARD_CACHE.move_to_end(pcb_file)
+            return cached
+        entry = [key, pcbnew.LoadBoard(pcb_file), None]
+        _BOARD_CACHE[pcb_file] = entry
+        _BOARD_CACHE.move_to_end(pcb_file)
+        while len(_BOARD_CACHE) > BOARD_CACHE_SIZE:
+            _BOARD_CACHE.popitem(last=False)
+        return entry
+
+def load_board(pcb_file):
+    """带缓存的 pcbnew.LoadBoard，文件变化后自动重新加载"""
+    return board_entry(pcb_file)[1]
+
+def board_stats(pcb_file):
+    """板子统计信息，与缓存的板子绑定"""
+    with PCBNEW_LOCK:
+        entry = board_entry(pcb_file)
+        if entry[2] is None:
+            entry[2] = compute_board_stats(entry[1])
+        return entry[2]
+
+def compute_board_stats(board):
+    # 板子尺寸
+    bbox = board.GetBoardEdgesBoundingBox()
+    width_mm = bbox.GetWidth() / IU_PER_MM
+    height_mm = bbox.GetHeight() / IU_PER_MM
+    
+    # 元件统计，每个封装只跨一次 SWIG 边界取属性
+    footprints = board.GetFootprints()
+    smd_count = 0
+    tht_count = 0
+    smd, tht = pcbnew.FP_SMD, pcbnew.FP_THROUGH_HOLE
+    for attrs in [fp.GetAttributes() for fp in footprints]:
+        if attrs & smd:
+            smd_count += 1
+        elif attrs & tht:
+            tht_count += 1
+    
+    # 过孔数
+    via_t = pcbnew.PCB_VIA_T
+    via_count = sum(1 for t in board.GetTracks() if t.Type() == via_t)
+    
+    return {
+        "success": True,
+        "board": {
+            "width_mm": round(width_mm, 2),
+            "height_mm": round(height_mm, 2),
+            "area_mm2": round(width_mm * height_mm, 2),
+            "layers": board.GetCopperLayerCount()
+        },
+        "components": {
+            "total": len(footprints),
+            "smd": smd_count,
+            "tht": tht_count
+        },
+        "nets": board.GetNetInfo().GetNetCount(),
+        "zones": count_items(board.Zones()),
+        "vias": via_count
+    }
+
+def count_items(seq):
+    """SWIG 容器计数，没有 size() 时逐个计数而不生成列表"""
+    try:
+        return seq.size()
+    except AttributeError:
+        return sum(1 for _ in seq)
+
+def drop_board(pcb_file):
+    """修改过板子 (SaveBoard 或中途失败) 后丢弃缓存"""
+    with PCBNEW_LOCK:
+        _BOARD_CACHE.pop(pcb_file, None)
 
 # ============================================================
 # 工具实现
@@ -68,22 +401,28 @@ def ensure_dirs(d):
 
 def tool_list_projects():
     """列出所有项目"""
+    now = time.monotonic()
+    if _LIST_PROJECTS_CACHE[1] is not None and now < _LIST_PROJECTS_CACHE[0]:
+        return _LIST_PROJECTS_CACHE[1]
+    
     projects = []
     if os.path.exists(PROJECTS_BASE):
-        for n in os.listdir(PROJECTS_BASE):
-            p = os.path.join(PROJECTS_BASE, n)
-            if os.path.isdir(p) and not n.startswith('.'):
-                pcb = find_pcb(p)
-                sch = find_sch(p)
-                projects.append({
-                    "name": n,
-                    "has_pcb": pcb is not None,
-                    "has_sch": sch is not None,
-                    "pcb_file": os.path.basename(pcb) if pcb else None
-                })
-    return {"projects": projects, "count": len(projects)}
-
-def tool_run_drc(project):
+        with os.scandir(PROJECTS_BASE) as it:
+            entries = [e for e in it if e.is_dir() and not e.name.startswith('.')]
+        for e in entries:
+            info = scan_project(e.path)
+            pcb = info["pcb"]
+            projects.append({
+                "name": e.name,
+                "has_pcb": pcb is not None,
+                "has_sch": info["sch"] is not None,
+                "pcb_file": os.path.basename(pcb) if pcb else None
+            })
+    result = {"projects": projects, "count": len(projects)}
+    _LIST_PROJECTS_CACHE[:] = [now + LIST_PROJECTS_TTL, result]
+    return result
+
+async def tool_run_drc(project):
     """DRC 设计规则检查"""
     d = os.path.join(PROJECTS_BASE, project)
     pcb = find_pcb(d)
@@ -92,21 +431,19 @@ def tool_run_drc(project):
     ensure_dirs(d)
     out = os.path.join(d, "output/reports/drc_report.json")
     
-    r = run_cmd([KICAD_CLI, "pcb", "drc", pcb, "--severity-all", "--format", "json", "--output", out])
+    r = await run_cmd_async([*CMD_PCB_DRC, pcb, "--severity-all", "--format", "json", "--output", out], capture=False)
     
     if r["success"] and os.path.exists(out):
-        with open(out) as f:
-            data = json.load(f)
-        v = data.get("violations", [])
+        count, v = read_violations(out)
         return {
             "success": True,
-            "violations": len(v),
+            "violations": count,
             "file": out,
-            "summary": [{"type": x.get("type"), "desc": x.get("description")} for x in v[:10]]
+            "summary": [{"type": x.get("type"), "desc": x.get("description")} for x in v]
         }
-    return {"success": False, "error": r.get("stderr", r.get("error"))}
+    return {"success": False, "error": cmd_error(r)}
 
-def tool_run_erc(project):
+async def tool_run_erc(project):
     """ERC 原理图电气检查"""
     d = os.path.join(PROJECTS_BASE, project)
     sch = find_sch(d)
@@ -115,19 +452,17 @@ def tool_run_erc(project):
     ensure_dirs(d)
     out = os.path.join(d, "output/reports/erc_report.json")
     
-    r = run_cmd([KICAD_CLI, "sch", "erc", sch, "--severity-all", "--format", "json", "--output", out])
+    r = await run_cmd_async([*CMD_SCH_ERC, sch, "--severity-all", "--format", "json", "--output", out], capture=False)
     
     if r["success"] and os.path.exists(out):
-        with open(out) as f:
-            data = json.load(f)
-        v = data.get("violations", data.get("errors", []))
+        count, v = read_violations(out, ("violations", "errors"))
         return {
             "success": True,
-            "violations": len(v) if isinstance(v, list) else 0,
+            "violations": count,
             "file": out,
-            "summary": [{"type": x.get("type"), "desc": x.get("description")} for x in (v[:10] if isinstance(v, list) else [])]
+            "summary": [{"type": x.get("type"), "desc": x.get("description")} for x in v]
         }
-    return {"success": False, "error": r.get("stderr", r.get("error"))}
+    return {"success": False, "error": cmd_error(r)}
 
 def tool_fill_zones(project):
     """填充所有 Zone (铜皮)"""
@@ -140,16 +475,20 @@ def tool_fill_zones(project):
         return {"error": f"PCB 文件未找到: {project}"}
     
     try:
-        board = pcbnew.LoadBoard(pcb_file)
-        zones = board.Zones()
-        zone_count = zones.size() if hasattr(zones, 'size') else len(list(zones))
-        
-        if zone_count == 0:
-            return {"success": True, "message": "没有 Zone 需要填充", "zones": 0}
-        
-        filler = pcbnew.ZONE_FILLER(board)
-        filler.Fill(board.Zones())
-        pcbnew.SaveBoard(pcb_file, board)
+        with PCBNEW_LOCK:
+            board = load_board(pcb_file)
+            zones = board.Zones()
+            zone_count = count_items(zones)
+            
+            if zone_count == 0:
+                return {"success": True, "message": "没有 Zone 需要填充", "zones": 0}
+            
+            try:
+                filler = pcbnew.ZONE_FILLER(board)
+                filler.Fill(zones)
+                pcbnew.SaveBoard(pcb_file, board)
+            finally:
+                drop_board(pcb_file)
         
         return {
             "success": True,
@@ -163,30 +502,235 @@ def tool_fill_zones(project):
 # ============================================================
 # 异步任务系统
 # ============================================================
+#
+# 异步任务由独立的 worker 进程执行 (本脚本 --run-task <task_id>)，
+# worker 直接 fork+exec FreeRouting 并在进程内导入 SES。
+# 任务状态记录在只追加的 journal.jsonl 中，每行一个事件，
+# 内存中的 _TASK_STATE 按顺序回放事件得到，只需增量读取新追加的部分。
+# 已结束的工具任务超过 2 * TASK_HISTORY 个时压缩 journal，只保留最近的 TASK_HISTORY 个。
 
 TASKS_DIR = "/root/pcb/tasks"
+TASK_JOURNAL = os.path.join(TASKS_DIR, "journal.jsonl")
+TASK_JOURNAL_LOCK = os.path.join(TASKS_DIR, "journal.lock")
+TASK_HISTORY = 50
+ROUTE_WORKERS = os.cpu_count() or 1
+ROUTE_TIMEOUT = 1200
+TOOL_WORKERS = min(4, os.cpu_count() or 1)
 
-def get_task_file(task_id):
-    return os.path.join(TASKS_DIR, f"{task_id}.json")
+_TASK_STATE = {}
+_TASK_JOURNAL_POS = [0, None]  # 已回放的字节数, journal 的 inode
+_TASK_LOCK = threading.Lock()
 
-def save_task(task_id, data):
+# 慢工具在线程池中执行，stdin 读循环不被阻塞
+_TOOL_POOL = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+_TOOL_FUTURES = {}
+
+def get_log_file(task_id):
+    return os.path.join(TASKS_DIR, f"{task_id}.log")
+
+def lock_journal(exclusive=False):
+    """journal 文件锁: 追加时共享，压缩 (替换文件) 时独占，避免并发追加的事件写进被替换掉的旧文件"""
     os.makedirs(TASKS_DIR, exist_ok=True)
-    with open(get_task_file(task_id), 'w') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    fd = os.open(TASK_JOURNAL_LOCK, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return fd
+
+def append_task_event(task_id, event, fields):
+    record = {"id": task_id, "event": event, "ts": time.time(), **fields}
+    line = json_bytes(record) + b"\n"
+    lock = lock_journal()
+    try:
+        # O_APPEND 单次 write，多进程同时追加也不会交错
+        fd = os.open(TASK_JOURNAL, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    finally:
+        os.close(lock)
+    refresh_tasks()
+
+def refresh_tasks():
+    """回放 journal 中尚未读取的事件 (包括 worker 进程追加的)"""
+    with _TASK_LOCK:
+        try:
+            f = open(TASK_JOURNAL, 'rb')
+        except OSError:
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != _TASK_JOURNAL_POS[1] or st.st_size < _TASK_JOURNAL_POS[0]:
+                # journal 被压缩替换或截断，从头回放
+                _TASK_STATE.clear()
+                _TASK_JOURNAL_POS[:] = [0, st.st_ino]
+            if st.st_size == _TASK_JOURNAL_POS[0]:
+                return
+            f.seek(_TASK_JOURNAL_POS[0])
+            data = f.read(st.st_size - _TASK_JOURNAL_POS[0])
+        end = data.rfind(b"\n") + 1  # 只消费完整的行
+        for line in data[:end].splitlines():
+            try:
+                record = json_loads(line)
+            except ValueError:
+                continue
+            task = _TASK_STATE.setdefault(record["id"], {"id": record["id"]})
+            task.update((k, v) for k, v in record.items() if k not in ("event", "ts"))
+            task["updated_at"] = record.get("ts")
+        _TASK_JOURNAL_POS[0] += end
+
+def finished_tool_tasks():
+    """已结束的工具任务 id (按创建顺序)，自动布线任务不算在内"""
+    return [t["id"] for t in list(_TASK_STATE.values())
+            if t.get("type") != "auto_route" and t.get("status") in ("completed", "failed", "cancelled")]
+
+def compact_tasks():
+    """把 journal 重写为每个任务一条快照，丢弃较早的已结束工具任务"""
+    refresh_tasks()
+    if len(finished_tool_tasks()) <= 2 * TASK_HISTORY:
+        return
+    lock = lock_journal(exclusive=True)
+    try:
+        # 拿到独占锁后再回放一次，包含其他进程刚追加的事件
+        refresh_tasks()
+        with _TASK_LOCK:
+            drop = set(finished_tool_tasks()[:-TASK_HISTORY])
+            tmp = f"{TASK_JOURNAL}.{os.getpid()}"
+            with open(tmp, 'wb') as f:
+                for task in _TASK_STATE.values():
+                    if task["id"] in drop:
+                        continue
+                    fields = {k: v for k, v in task.items() if k != "updated_at"}
+                    f.write(json_bytes({**fields, "event": "created", "ts": task.get("updated_at")}) + b"\n")
+            os.replace(tmp, TASK_JOURNAL)
+    finally:
+        os.close(lock)
+    refresh_tasks()
+
+def save_task(task_id, data):
+    append_task_event(task_id, "created", data)
 
 def load_task(task_id):
-    tf = get_task_file(task_id)
-    if os.path.exists(tf):
-        with open(tf) as f:
-            return json.load(f)
-    return None
+    refresh_tasks()
+    task = _TASK_STATE.get(task_id)
+    return dict(task) if task else None
+
+def update_task(task_id, **fields):
+    append_task_event(task_id, "updated", fields)
+    return load_task(task_id)
+
+def pid_alive(pid):
+    try:
+        # 本进程启动的 worker 退出后会成为僵尸进程，kill(pid, 0) 仍然成功，先尝试回收
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    except ChildProcessError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def check_worker(task):
+    """worker 进程异常退出时把任务标记为失败"""
+    if task.get("status") in ("queued", "started") and task.get("pid") and not pid_alive(task["pid"]):
+        task = update_task(task["id"], status="failed", error="worker 进程已退出")
+    return task
+
+def route_cmd(dsn_file, ses_file, max_passes):
+    return [
+        "xvfb-run", "-a",
+        JAVA_CMD, "-jar", FREEROUTING_JAR,
+        "-de", dsn_file,
+        "-do", ses_file,
+        "-mp", str(max_passes)
+    ]
+
+def import_ses(pcb_file, dsn_file, ses_file):
+    """导入 SES 布线结果并清理临时文件"""
+    with PCBNEW_LOCK:
+        try:
+            board = load_board(pcb_file)
+            pcbnew.ImportSpecctraSES(board, ses_file)
+            pcbnew.SaveBoard(pcb_file, board)
+        finally:
+            drop_board(pcb_file)
+    for f in (dsn_file, ses_file):
+        if os.path.exists(f):
+            os.remove(f)
+
+async def run_freerouting(dsn_file, ses_file, max_passes, log_file=None, timeout=ROUTE_TIMEOUT):
+    """运行 FreeRouting，超时或被取消时结束整个进程组 (xvfb-run/Xvfb/java)"""
+    with open(log_file or os.devnull, 'wb') as lf:
+        proc = await asyncio.create_subprocess_exec(
+            *route_cmd(dsn_file, ses_file, max_passes),
+            stdin=subprocess.DEVNULL, stdout=lf, stderr=subprocess.STDOUT,
+            start_new_session=True
+        )
+        try:
+            return await asyncio.wait_for(proc.wait(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            await stop_process_group(proc)
+            raise
+
+async def stop_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        await asyncio.wait_for(proc.wait(), 5)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+
+async def route_task_main(task_id, task):
+    # cancel_task 发送 SIGTERM，转为取消当前协程
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    await run_freerouting(task["dsn"], task["ses"], task["max_passes"], get_log_file(task_id))
+
+def run_route_task(task_id):
+    """worker 入口: 执行 FreeRouting 并导入结果"""
+    task = load_task(task_id)
+    if not task or task.get("status") == "cancelled":
+        return
+    task = update_task(task_id, status="started", pid=os.getpid())
+    try:
+        asyncio.run(route_task_main(task_id, task))
+        # 事件循环关闭后 SIGTERM 恢复默认动作，导入/保存板子期间被结束会留下写了一半的 .kicad_pcb
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        if not os.path.exists(task["ses"]):
+            update_task(task_id, status="failed", error="FreeRouting 未生成 SES 文件")
+            return
+        update_task(task_id, stage="importing")
+        import_ses(task["pcb"], task["dsn"], task["ses"])
+        update_task(task_id, status="completed")
+    except asyncio.CancelledError:
+        update_task(task_id, status="cancelled")
+    except asyncio.TimeoutError:
+        update_task(task_id, status="failed", error=f"自动布线超时 (>{ROUTE_TIMEOUT // 60}分钟)")
+    except Exception as e:
+        update_task(task_id, status="failed", error=str(e))
+
+def running_route_tasks():
+    refresh_tasks()
+    count = 0
+    for task in list(_TASK_STATE.values()):
+        if task.get("type") == "auto_route" and check_worker(task).get("status") in ("queued", "started"):
+            count += 1
+    return count
 
 def tool_auto_route(project, max_passes=100, async_mode=True):
     """FreeRouting 自动布线 (默认异步)"""
     if not HAS_PCBNEW:
         return {"error": "pcbnew 模块不可用"}
     
-    if not os.path.exists(FREEROUTING_JAR):
+    if not FREEROUTING_AVAILABLE:
         return {"error": f"FreeRouting 未安装: {FREEROUTING_JAR}"}
     
     d = os.path.join(PROJECTS_BASE, project)
@@ -194,6 +738,9 @@ def tool_auto_route(project, max_passes=100, async_mode=True):
     if not pcb_file:
         return {"error": f"PCB 文件未找到: {project}"}
     
+    if async_mode and running_route_tasks() >= ROUTE_WORKERS:
+        return {"error": f"已有 {ROUTE_WORKERS} 个布线任务在运行，请稍后再试"}
+    
     ensure_dirs(d)
     
     # 创建备份
@@ -201,7 +748,7 @@ def tool_auto_route(project, max_passes=100, async_mode=True):
     os.makedirs(backup_dir, exist_ok=True)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_file = os.path.join(backup_dir, f"before_autoroute_{timestamp}.kicad_pcb")
-    shutil.copy(pcb_file, backup_file)
+    shutil.copyfile(pcb_file, backup_file)
     
     # 临时文件
     dsn_file = os.path.join(d, "output/temp_route.dsn")
@@ -209,61 +756,39 @@ def tool_auto_route(project, max_passes=100, async_mode=True):
     
     # 导出 DSN
     try:
-        board = pcbnew.LoadBoard(pcb_file)
-        pcbnew.ExportSpecctraDSN(board, dsn_file)
-        log(f"DSN 导出完成: {dsn_file}")
+        with PCBNEW_LOCK:
+            board = load_board(pcb_file)
+            pcbnew.ExportSpecctraDSN(board, dsn_file)
+        logger.info("DSN 导出完成: %s", dsn_file)
     except Exception as e:
         return {"success": False, "error": f"DSN 导出失败: {e}"}
     
     if async_mode:
-        # 异步模式：后台执行
+        # 异步模式：交给独立 worker 进程执行
         task_id = f"route_{project}_{timestamp}"
         
-        # 创建后台脚本
-        script = f'''#!/bin/bash
-cd {d}
-echo "started" > /root/pcb/tasks/{task_id}.status
-
-xvfb-run -a java -jar {FREEROUTING_JAR} -de {dsn_file} -do {ses_file} -mp {max_passes} > /root/pcb/tasks/{task_id}.log 2>&1
-
-if [ -f "{ses_file}" ]; then
-    python3 << 'PYEOF'
-import pcbnew
-board = pcbnew.LoadBoard("{pcb_file}")
-pcbnew.ImportSpecctraSES(board, "{ses_file}")
-pcbnew.SaveBoard("{pcb_file}", board)
-print("SES imported")
-PYEOF
-    rm -f {dsn_file} {ses_file}
-    echo "completed" > /root/pcb/tasks/{task_id}.status
-else
-    echo "failed" > /root/pcb/tasks/{task_id}.status
-fi
-'''
-        script_file = f"/root/pcb/tasks/{task_id}.sh"
-        os.makedirs(TASKS_DIR, exist_ok=True)
-        with open(script_file, 'w') as f:
-            f.write(script)
-        os.chmod(script_file, 0o755)
-        
-        # 保存任务信息
         save_task(task_id, {
             "id": task_id,
             "type": "auto_route",
             "project": project,
-            "status": "running",
+            "status": "queued",
             "started_at": timestamp,
             "backup": backup_file,
-            "pcb": pcb_file
+            "pcb": pcb_file,
+            "dsn": dsn_file,
+            "ses": ses_file,
+            "max_passes": max_passes
         })
         
-        # 后台启动
-        subprocess.Popen(
-            ["nohup", "bash", script_file],
+        worker = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--run-task", task_id],
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
             start_new_session=True
         )
+        # 只写 pid 不改状态: worker 启动前就退出时 check_worker 也能发现
+        update_task(task_id, pid=worker.pid)
         
         return {
             "success": True,
@@ -276,25 +801,12 @@ fi
     else:
         # 同步模式（保留，但有超时风险）
         try:
-            cmd = [
-                "xvfb-run", "-a",
-                JAVA_CMD, "-jar", FREEROUTING_JAR,
-                "-de", dsn_file,
-                "-do", ses_file,
-                "-mp", str(max_passes)
-            ]
-            
-            r = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+            asyncio.run(run_freerouting(dsn_file, ses_file, max_passes, timeout=600))
             
             if not os.path.exists(ses_file):
                 return {"success": False, "error": "FreeRouting 未生成 SES 文件"}
             
-            board = pcbnew.LoadBoard(pcb_file)
-            pcbnew.ImportSpecctraSES(board, ses_file)
-            pcbnew.SaveBoard(pcb_file, board)
-            
-            os.remove(dsn_file) if os.path.exists(dsn_file) else None
-            os.remove(ses_file) if os.path.exists(ses_file) else None
+            import_ses(pcb_file, dsn_file, ses_file)
             
             return {
                 "success": True,
@@ -302,62 +814,98 @@ fi
                 "backup": backup_file,
                 "pcb": pcb_file
             }
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             return {"success": False, "error": "自动布线超时 (>10分钟)，建议使用异步模式"}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+def tail_lines(path, n, block=4096):
+    """从文件末尾读取最后 n 行，窗口不够时加倍，不读入整个文件"""
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        window = block
+        while True:
+            start = max(0, size - window)
+            f.seek(start)
+            lines = f.read(size - start).splitlines(keepends=True)
+            # 窗口第一行可能不完整，需要多读到一行
+            if start == 0 or len(lines) > n:
+                break
+            window *= 2
+    return b"".join(lines[-n:]).decode(errors='replace')
+
 def tool_get_task_status(task_id):
     """查询异步任务状态"""
     task = load_task(task_id)
     if not task:
         return {"error": f"任务不存在: {task_id}"}
-    
-    status_file = os.path.join(TASKS_DIR, f"{task_id}.status")
-    log_file = os.path.join(TASKS_DIR, f"{task_id}.log")
-    
-    # 读取状态
-    status = "unknown"
-    if os.path.exists(status_file):
-        with open(status_file) as f:
-            status = f.read().strip()
+    task = check_worker(task)
     
     # 读取日志尾部
     log_tail = ""
+    log_file = get_log_file(task_id)
     if os.path.exists(log_file):
-        with open(log_file) as f:
-            lines = f.readlines()
-            log_tail = ''.join(lines[-10:])
+        log_tail = tail_lines(log_file, 10)
     
-    task["status"] = status
     task["log_tail"] = log_tail
     
-    if status == "completed":
+    status = task.get("status")
+    if task.get("type") != "auto_route":
+        if status == "completed":
+            task["message"] = "任务完成，结果见 result"
+        elif status == "failed":
+            task["message"] = "任务失败，查看 error/result 了解详情"
+        elif status == "cancelled":
+            task["message"] = "任务已取消"
+        elif status in ("queued", "started"):
+            task["message"] = "任务执行中..."
+    elif status == "completed":
         task["message"] = "自动布线完成！PCB 文件已更新"
     elif status == "failed":
         task["message"] = "自动布线失败，查看日志了解详情"
-    elif status == "started":
+    elif status == "cancelled":
+        task["message"] = "自动布线已取消"
+    elif status in ("queued", "started"):
         task["message"] = "正在布线中..."
     
     return task
 
+def tool_cancel_task(task_id):
+    """取消正在运行的异步任务"""
+    task = load_task(task_id)
+    if not task:
+        return {"error": f"任务不存在: {task_id}"}
+    task = check_worker(task)
+    if task.get("status") not in ("queued", "started"):
+        return {"error": f"任务已结束: {task.get('status')}"}
+    
+    if task.get("type") != "auto_route":
+        # 线程池任务只能在开始执行前取消
+        future = _TOOL_FUTURES.get(task_id)
+        if not future or not future.cancel():
+            return {"error": "任务已在执行，无法取消"}
+        update_task(task_id, status="cancelled")
+        return {"success": True, "task_id": task_id, "message": "任务已取消"}
+    
+    if task.get("stage") == "importing":
+        return {"error": "布线已完成，正在导入结果，无法取消"}
+    
+    pid = task.get("pid")
+    if task.get("status") == "queued":
+        # worker 尚未开始布线，启动后会看到取消状态直接退出
+        update_task(task_id, status="cancelled")
+    if pid:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            check_worker(task)
+    return {"success": True, "task_id": task_id, "message": "已发送取消请求，使用 get_task_status 确认"}
+
 def tool_list_tasks():
     """列出所有任务"""
-    if not os.path.exists(TASKS_DIR):
-        return {"tasks": [], "count": 0}
-    
-    tasks = []
-    for f in os.listdir(TASKS_DIR):
-        if f.endswith('.json'):
-            task_id = f[:-5]
-            task = load_task(task_id)
-            if task:
-                status_file = os.path.join(TASKS_DIR, f"{task_id}.status")
-                if os.path.exists(status_file):
-                    with open(status_file) as sf:
-                        task["status"] = sf.read().strip()
-                tasks.append(task)
-    
+    refresh_tasks()
+    # 结果可能很大，只在 get_task_status 中返回
+    tasks = [{k: v for k, v in check_worker(dict(t)).items() if k != "result"} for t in list(_TASK_STATE.values())]
     return {"tasks": tasks, "count": len(tasks)}
 
 def tool_get_board_info(project):
@@ -371,61 +919,56 @@ def tool_get_board_info(project):
         return {"error": f"PCB 文件未找到: {project}"}
     
     try:
-        board = pcbnew.LoadBoard(pcb_file)
-        
-        # 板子尺寸
-        bbox = board.GetBoardEdgesBoundingBox()
-        width_mm = bbox.GetWidth() / 1000000.0
-        height_mm = bbox.GetHeight() / 1000000.0
-        
-        # 层数
-        layer_count = board.GetCopperLayerCount()
-        
-        # 元件统计
-        footprints = board.GetFootprints()
-        fp_count = len(footprints)
-        
-        smd_count = 0
-        tht_count = 0
-        for fp in footprints:
-            if fp.GetAttributes() & pcbnew.FP_SMD:
-                smd_count += 1
-            elif fp.GetAttributes() & pcbnew.FP_THROUGH_HOLE:
-                tht_count += 1
-        
-        # 网络数
-        netinfo = board.GetNetInfo()
-        net_count = netinfo.GetNetCount()
-        
-        # Zone 数
-        zones = board.Zones()
-        zone_count = zones.size() if hasattr(zones, 'size') else len(list(zones))
-        
-        # 过孔数
-        tracks = board.GetTracks()
-        via_count = sum(1 for t in tracks if t.GetClass() == "PCB_VIA")
-        
-        return {
-            "success": True,
-            "board": {
-                "width_mm": round(width_mm, 2),
-                "height_mm": round(height_mm, 2),
-                "area_mm2": round(width_mm * height_mm, 2),
-                "layers": layer_count
-            },
-            "components": {
-                "total": fp_count,
-                "smd": smd_count,
-                "tht": tht_count
-            },
-            "nets": net_count,
-            "zones": zone_count,
-            "vias": via_count
-        }
+        return board_stats(pcb_file)
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-def tool_export_gerber(project):
+def plot_gerber_and_drill(pcb_file, out_dir):
+    """进程内导出 Gerber + 钻孔，PCB 只解析一次
+
+    图层按板子自身的绘图设置选择，与 KiCad 中“绘图”对话框一致。
+    """
+    with PCBNEW_LOCK:
+        board = load_board(pcb_file)
+        
+        pc = pcbnew.PLOT_CONTROLLER(board)
+        po = pc.GetPlotOptions()
+        po.SetOutputDirectory(out_dir)
+        layers = list(po.GetLayerSelection().Seq())
+        if not layers:
+            raise RuntimeError("板子绘图设置未选择任何图层")
+        for layer in layers:
+            name = board.GetLayerName(layer)
+            pc.SetLayer(layer)
+            pc.OpenPlotfile(name.replace(".", "_"), pcbnew.PLOT_FORMAT_GERBER, name)
+            if not pc.PlotLayer():
+                raise RuntimeError(f"图层绘制失败: {name}")
+        pc.ClosePlot()
+    
+        drill = pcbnew.EXCELLON_WRITER(board)
+        drill.SetOptions(False, False, pcbnew.VECTOR2I(0, 0), False)
+        drill.SetFormat(True)
+        drill.CreateDrillandMapFilesSet(out_dir, True, False)
+
+async def export_gerber_and_drill(pcb, out):
+    """导出 Gerber + 钻孔，返回 (成功, 错误信息)
+
+    有 pcbnew 时在进程内完成，失败再退回两次 kicad-cli 调用。
+    """
+    if HAS_PCBNEW:
+        try:
+            await asyncio.to_thread(plot_gerber_and_drill, pcb, out)
+            return True, None
+        except Exception as e:
+            logger.warning("进程内 Gerber 导出失败，改用 kicad-cli: %s", e)
+    
+    r1 = await run_cmd_async([*CMD_GERBERS, "--output", out + "/", pcb], capture=False)
+    r2 = await run_cmd_async([*CMD_DRILL, "--output", out + "/", pcb], capture=False)
+    if r1["success"] and r2["success"]:
+        return True, None
+    return False, (cmd_error(r1) + " " + cmd_error(r2)).strip()
+
+async def tool_export_gerber(project):
     """导出 Gerber + 钻孔文件"""
     d = os.path.join(PROJECTS_BASE, project)
     pcb = find_pcb(d)
@@ -434,15 +977,14 @@ def tool_export_gerber(project):
     ensure_dirs(d)
     out = os.path.join(d, "output/gerber")
     
-    r1 = run_cmd([KICAD_CLI, "pcb", "export", "gerbers", "--output", out + "/", pcb])
-    r2 = run_cmd([KICAD_CLI, "pcb", "export", "drill", "--output", out + "/", pcb])
+    ok, err = await export_gerber_and_drill(pcb, out)
     
-    if r1["success"] and r2["success"]:
+    if ok:
         files = os.listdir(out)
         return {"success": True, "dir": out, "files": files, "count": len(files)}
-    return {"success": False, "error": (r1.get("stderr", "") + " " + r2.get("stderr", "")).strip()}
+    return {"success": False, "error": err}
 
-def tool_export_bom(project):
+async def tool_export_bom(project):
     """导出 BOM"""
     d = os.path.join(PROJECTS_BASE, project)
     sch = find_sch(d)
@@ -451,15 +993,15 @@ def tool_export_bom(project):
     ensure_dirs(d)
     out = os.path.join(d, "output/bom/bom.csv")
     
-    r = run_cmd([KICAD_CLI, "sch", "export", "bom", "--output", out, sch])
+    r = await run_cmd_async([*CMD_BOM, "--output", out, sch], capture=False)
     
     if r["success"] and os.path.exists(out):
         with open(out) as f:
             lines = f.readlines()
         return {"success": True, "file": out, "lines": len(lines), "preview": lines[:5]}
-    return {"success": False, "error": r.get("stderr", r.get("error"))}
+    return {"success": False, "error": cmd_error(r)}
 
-def tool_export_netlist(project, format="kicadxml"):
+async def tool_export_netlist(project, format="kicadxml"):
     """导出网表"""
     d = os.path.join(PROJECTS_BASE, project)
     sch = find_sch(d)
@@ -471,13 +1013,13 @@ def tool_export_netlist(project, format="kicadxml"):
     ext = ext_map.get(format, "net")
     out = os.path.join(d, f"output/netlist/netlist.{ext}")
     
-    r = run_cmd([KICAD_CLI, "sch", "export", "netlist", "--format", format, "--output", out, sch])
+    r = await run_cmd_async([*CMD_NETLIST, "--format", format, "--output", out, sch], capture=False)
     
     if r["success"] and os.path.exists(out):
         return {"success": True, "file": out, "format": format}
-    return {"success": False, "error": r.get("stderr", r.get("error"))}
+    return {"success": False, "error": cmd_error(r)}
 
-def tool_export_sch_pdf(project):
+async def tool_export_sch_pdf(project):
     """导出原理图 PDF"""
     d = os.path.join(PROJECTS_BASE, project)
     sch = find_sch(d)
@@ -486,13 +1028,18 @@ def tool_export_sch_pdf(project):
     ensure_dirs(d)
     out = os.path.join(d, "output/docs/schematic.pdf")
     
-    r = run_cmd([KICAD_CLI, "sch", "export", "pdf", "--output", out, sch])
+    r = await run_cmd_async([*CMD_SCH_PDF, "--output", out, sch], capture=False)
     
     if r["success"] and os.path.exists(out):
         return {"success": True, "file": out}
-    return {"success": False, "error": r.get("stderr", r.get("error"))}
+    return {"success": False, "error": cmd_error(r)}
 
-def tool_export_sch_svg(project):
+def svg_mtimes(d):
+    """目录下 SVG 文件名 -> mtime_ns"""
+    with os.scandir(d) as it:
+        return {e.name: e.stat().st_mtime_ns for e in it if e.name.endswith(".svg") and not e.name.startswith('.')}
+
+async def tool_export_sch_svg(project):
     """导出原理图 SVG"""
     d = os.path.join(PROJECTS_BASE, project)
     sch = find_sch(d)
@@ -501,14 +1048,24 @@ def tool_export_sch_svg(project):
     ensure_dirs(d)
     out_dir = os.path.join(d, "output/images")
     
-    r = run_cmd([KICAD_CLI, "sch", "export", "svg", "--output", out_dir + "/", sch])
+    before = svg_mtimes(out_dir)
+    r = await run_cmd_async([*CMD_SCH_SVG, "--output", out_dir + "/", sch], capture=False)
     
     if r["success"]:
-        svg_files = glob.glob(os.path.join(out_dir, "*.svg"))
+        # 只返回本次新生成或被覆盖的文件，不混入 PCB SVG 等旧文件
+        after = svg_mtimes(out_dir)
+        svg_files = sorted(os.path.join(out_dir, n) for n, m in after.items() if before.get(n) != m)
         return {"success": True, "files": svg_files}
-    return {"success": False, "error": r.get("stderr", r.get("error"))}
+    return {"success": False, "error": cmd_error(r)}
+
+RENDER_WORKERS = min(3, os.cpu_count() or 1)
+# 光线追踪渲染吃满 CPU，全局限制并发数 (多个 export_3d/export_all 可能在不同线程同时执行)。
+# 每个槽位带一个独占的 Xvfb 起始显示号，并发渲染的 xvfb-run -a 不会从同一个号开始探测
+RENDER_SLOTS = queue.Queue()
+for n in range(RENDER_WORKERS):
+    RENDER_SLOTS.put(99 + n * 10)
 
-def tool_export_3d(project, view="top"):
+async def tool_export_3d(project, view="top"):
     """3D 渲染"""
     d = os.path.join(PROJECTS_BASE, project)
     pcb = find_pcb(d)
@@ -533,13 +1090,12 @@ def tool_export_3d(project, view="top"):
     else:
         return {"error": f"未知视图: {view}，可选: top, bottom, front, back, iso, iso_back, all"}
     
-    results = {}
-    for v in views_to_render:
+    async def render(v):
         cfg = views_config[v]
         out_file = os.path.join(out_dir, f"pcb_{v}.png")
         
         cmd = [
-            KICAD_CLI, "pcb", "render",
+            *CMD_RENDER,
             "--output", out_file,
             "--width", "1920",
             "--height", "1080",
@@ -554,16 +1110,24 @@ def tool_export_3d(project, view="top"):
         
         cmd.append(pcb)
         
-        r = run_cmd(cmd, cwd=d, use_xvfb=True)
+        # 在线程中阻塞等待全局渲染槽位，不占住事件循环
+        display = await asyncio.to_thread(RENDER_SLOTS.get)
+        try:
+            r = await run_cmd_async(cmd, cwd=d, use_xvfb=True, xvfb_num=display, capture=False)
+        finally:
+            RENDER_SLOTS.put(display)
         success = r["success"] and os.path.exists(out_file)
         
-        results[v] = {
+        return {
             "success": success,
             "file": out_file if success else None,
             "size": f"{os.path.getsize(out_file)/1024:.1f}KB" if success else None,
-            "error": r.get("stderr") if not success else None
+            "error": cmd_error(r) if not success else None
         }
     
+    rendered = await asyncio.gather(*(render(v) for v in views_to_render))
+    results = dict(zip(views_to_render, rendered))
+    
     success_count = sum(1 for r in results.values() if r["success"])
     files = [r["file"] for r in results.values() if r["file"]]
     
@@ -574,7 +1138,7 @@ def tool_export_3d(project, view="top"):
         "message": f"生成 {success_count}/{len(views_to_render)} 个 3D 渲染图"
     }
 
-def tool_export_svg(project, view="all"):
+async def tool_export_svg(project, view="all"):
     """导出 PCB SVG 图片"""
     d = os.path.join(PROJECTS_BASE, project)
     pcb = find_pcb(d)
@@ -601,7 +1165,7 @@ def tool_export_svg(project, view="all"):
         out_file = os.path.join(out_dir, f"pcb_{v}.svg")
         
         cmd = [
-            KICAD_CLI, "pcb", "export", "svg",
+            *CMD_PCB_SVG,
             "--output", out_file,
             "--layers", cfg["layers"],
             "--page-size-mode", "2",
@@ -613,14 +1177,14 @@ def tool_export_svg(project, view="all"):
         
         cmd.append(pcb)
         
-        r = run_cmd(cmd, cwd=d)
+        r = await run_cmd_async(cmd, cwd=d, capture=False)
         success = r["success"] and os.path.exists(out_file)
         results[v] = {"success": success, "file": out_file if success else None}
     
     files = [r["file"] for r in results.values() if r["file"]]
     return {"success": len(files) > 0, "files": files, "results": results}
 
-def tool_export_pdf(project, layers="all"):
+async def tool_export_pdf(project, layers="all"):
     """导出 PCB PDF"""
     d = os.path.join(PROJECTS_BASE, project)
     pcb = find_pcb(d)
@@ -637,13 +1201,13 @@ def tool_export_pdf(project, layers="all"):
     layer_str = layer_sets.get(layers, layers)
     out_file = os.path.join(d, f"output/docs/pcb_{layers}.pdf")
     
-    r = run_cmd([KICAD_CLI, "pcb", "export", "pdf", "--output", out_file, "--layers", layer_str, pcb])
+    r = await run_cmd_async([*CMD_PCB_PDF, "--output", out_file, "--layers", layer_str, pcb], capture=False)
     
     if r["success"] and os.path.exists(out_file):
         return {"success": True, "file": out_file}
-    return {"success": False, "error": r.get("stderr", r.get("error"))}
+    return {"success": False, "error": cmd_error(r)}
 
-def tool_export_step(project):
+async def tool_export_step(project):
     """导出 STEP 3D 模型"""
     d = os.path.join(PROJECTS_BASE, project)
     pcb = find_pcb(d)
@@ -652,14 +1216,14 @@ def tool_export_step(project):
     ensure_dirs(d)
     out_file = os.path.join(d, "output/3d/pcb.step")
     
-    r = run_cmd([KICAD_CLI, "pcb", "export", "step", "--output", out_file, "--subst-models", pcb])
+    r = await run_cmd_async([*CMD_STEP, "--output", out_file, "--subst-models", pcb], capture=False)
     
     if r["success"] and os.path.exists(out_file):
         size = os.path.getsize(out_file)
         return {"success": True, "file": out_file, "size": f"{size/1024/1024:.1f}MB"}
-    return {"success": False, "error": r.get("stderr", r.get("error"))}
+    return {"success": False, "error": cmd_error(r)}
 
-def tool_export_jlcpcb(project):
+async def tool_export_jlcpcb(project):
     """JLCPCB 完整制造包"""
     d = os.path.join(PROJECTS_BASE, project)
     pcb = find_pcb(d)
@@ -672,27 +1236,25 @@ def tool_export_jlcpcb(project):
     
     results = {}
     
-    r1 = run_cmd([KICAD_CLI, "pcb", "export", "gerbers", "--output", jd + "/", pcb])
-    r2 = run_cmd([KICAD_CLI, "pcb", "export", "drill", "--output", jd + "/", pcb])
-    results["gerber"] = r1["success"] and r2["success"]
+    results["gerber"], _ = await export_gerber_and_drill(pcb, jd)
     
     if sch:
         bom_file = os.path.join(jd, "bom.csv")
-        r3 = run_cmd([KICAD_CLI, "sch", "export", "bom", "--output", bom_file, sch])
+        r3 = await run_cmd_async([*CMD_BOM, "--output", bom_file, sch], capture=False)
         results["bom"] = r3["success"]
     else:
         results["bom"] = False
     
     pos_file = os.path.join(jd, "position.csv")
-    r4 = run_cmd([
-        KICAD_CLI, "pcb", "export", "pos",
+    r4 = await run_cmd_async([
+        *CMD_POS,
         "--output", pos_file,
         "--format", "csv",
         "--units", "mm",
         "--side", "both",
         "--smd-only",
         pcb
-    ])
+    ], capture=False)
     results["position"] = r4["success"] and os.path.exists(pos_file)
     
     files = os.listdir(jd) if os.path.exists(jd) else []
@@ -706,20 +1268,22 @@ def tool_export_jlcpcb(project):
         "message": "JLCPCB 文件包已生成"
     }
 
-def tool_export_all(project):
+async def tool_export_all(project):
     """导出所有文件"""
-    results = {}
-    
-    results["drc"] = tool_run_drc(project)
-    results["erc"] = tool_run_erc(project)
-    results["gerber"] = tool_export_gerber(project)
-    results["bom"] = tool_export_bom(project)
-    results["3d"] = tool_export_3d(project, "all")
-    results["svg"] = tool_export_svg(project, "all")
-    results["sch_pdf"] = tool_export_sch_pdf(project)
+    names = ["drc", "erc", "gerber", "bom", "3d", "svg", "sch_pdf"]
+    done = await asyncio.gather(
+        tool_run_drc(project),
+        tool_run_erc(project),
+        tool_export_gerber(project),
+        tool_export_bom(project),
+        tool_export_3d(project, "all"),
+        tool_export_svg(project, "all"),
+        tool_export_sch_pdf(project)
+    )
+    results = dict(zip(names, done))
     
     d = os.path.join(PROJECTS_BASE, project, "output")
-    total_files = sum(len(files) for _, _, files in os.walk(d)) if os.path.exists(d) else 0
+    total_files = sum(1 for _ in iter_files(d)) if os.path.exists(d) else 0
     
     return {
         "success": True,
@@ -735,52 +1299,102 @@ def tool_get_files(project):
         return {"files": [], "error": "输出目录不存在"}
     
     files = []
-    for root, _, fnames in os.walk(d):
-        for f in fnames:
-            fp = os.path.join(root, f)
-            rel = os.path.relpath(fp, d)
-            size = os.path.getsize(fp)
-            files.append({
-                "name": f,
-                "path": rel,
-                "full_path": fp,
-                "size": f"{size/1024:.1f}KB" if size > 1024 else f"{size}B"
-            })
+    for e in iter_files(d):
+        size = e.stat().st_size
+        files.append({
+            "name": e.name,
+            "path": os.path.relpath(e.path, d),
+            "full_path": e.path,
+            "size": f"{size/1024:.1f}KB" if size > 1024 else f"{size}B"
+        })
     return {"files": files, "count": len(files)}
 
-def tool_read_file(filepath):
-    """读取文件内容"""
+B64_CHUNK = 57 * 1024
+READ_WINDOW = 256 * 1024
+READ_MAX = 10 * 1024 * 1024
+BINARY_EXTS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.zip', '.pdf', '.step', '.glb'})
+
+def b64_encode(data):
+    # 分块编码，块大小为 3 的倍数，拼接结果与整体编码一致
+    encoded = bytearray()
+    view = memoryview(data)
+    for i in range(0, len(view), B64_CHUNK):
+        encoded += base64.b64encode(view[i:i + B64_CHUNK])
+    return encoded.decode('ascii')
+
+def utf8_boundary(data):
+    """返回不切断末尾 UTF-8 多字节字符的长度"""
+    n = len(data)
+    for i in range(n - 1, max(n - 4, -1), -1):
+        b = data[i]
+        if b & 0xC0 != 0x80:
+            need = 1 if b < 0x80 else 2 if b < 0xE0 else 3 if b < 0xF0 else 4
+            return n if i + need <= n or i == 0 else i
+    return n
+
+def tool_read_file(filepath, offset=0, length=None):
+    """读取文件内容，大文件或指定 offset/length 时按窗口读取"""
     if not os.path.exists(filepath):
         return {"error": f"文件不存在: {filepath}"}
     
     size = os.path.getsize(filepath)
-    if size > 10 * 1024 * 1024:
-        return {"error": "文件过大 (>10MB)"}
+    binary = os.path.splitext(filepath)[1].lower() in BINARY_EXTS
     
-    ext = os.path.splitext(filepath)[1].lower()
-    binary_exts = {'.png', '.jpg', '.jpeg', '.gif', '.zip', '.pdf', '.step', '.glb'}
-    
-    if ext in binary_exts:
-        with open(filepath, 'rb') as f:
-            content = base64.b64encode(f.read()).decode()
-        return {"encoding": "base64", "content": content, "size": size}
-    else:
+    if size <= READ_WINDOW and not offset and length is None:
+        if binary:
+            with open(filepath, 'rb') as f:
+                return {"encoding": "base64", "content": b64_encode(f.read()), "size": size}
         with open(filepath, 'r', errors='replace') as f:
             content = f.read()
         return {"encoding": "utf-8", "content": content, "size": size}
+    
+    # 窗口读取: os.pread 只读需要的字节，next_offset 用于继续读下一段
+    if offset < 0 or offset > size:
+        return {"error": f"offset 超出范围: {offset} (文件大小 {size})"}
+    length = min(READ_WINDOW if length is None else length, READ_MAX)
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        data = os.pread(fd, length, offset)
+    finally:
+        os.close(fd)
+    
+    end = offset + len(data)
+    if binary:
+        content = b64_encode(data)
+    else:
+        if end < size:
+            data = data[:utf8_boundary(data)]
+            end = offset + len(data)
+        content = data.decode(errors='replace')
+    return {
+        "encoding": "base64" if binary else "utf-8",
+        "content": content,
+        "size": size,
+        "offset": offset,
+        "next_offset": end,
+        "eof": end >= size
+    }
+
+_VERSION_INFO = [None]
 
 def tool_version():
-    """获取版本信息"""
+    """获取版本信息 (进程内只计算一次，main 启动时已在后台预取)"""
+    if _VERSION_INFO[0] is None:
+        _VERSION_INFO[0] = _TOOL_POOL.submit(version_info)
+    return _VERSION_INFO[0].result()
+
+def version_info():
     r = run_cmd([KICAD_CLI, "--version"])
-    freerouting_ok = os.path.exists(FREEROUTING_JAR)
     return {
-        "kicad": r["stdout"].strip() if r["success"] else "未安装",
+        "kicad": r["stdout"].decode(errors="replace").strip() if r["success"] else "未安装",
         "pcbnew_api": HAS_PCBNEW,
-        "freerouting": freerouting_ok,
+        "freerouting": FREEROUTING_AVAILABLE,
         "mcp_server": "3.4",
         "features": [
-            "drc", "erc", "fill_zones", "board_info", 
-            "auto_route_async", "task_status",
+            "drc", "erc", "fill_zones", "board_info",
+            # 未安装 FreeRouting 时 auto_route 不在 TOOLS 中
+            *(["auto_route_async"] if FREEROUTING_AVAILABLE else []),
+            "async_tools", "task_status", "task_cancel",
             "gerber", "drill", "bom", "netlist", "pos",
             "3d_render", "svg", "pdf", "step",
             "sch_pdf", "sch_svg"
@@ -820,6 +1434,10 @@ TOOLS = {
         "desc": "查询异步任务状态",
         "schema": {"type": "object", "properties": {"task_id": {"type": "string"}}, "required": ["task_id"]}
     },
+    "cancel_task": {
+        "desc": "取消正在运行的异步任务",
+        "schema": {"type": "object", "properties": {"task_id": {"type": "string"}}, "required": ["task_id"]}
+    },
     "list_tasks": {
         "desc": "列出所有异步任务",
         "schema": {"type": "object", "properties": {}, "required": []}
@@ -878,7 +1496,11 @@ TOOLS = {
     },
     "read_file": {
         "desc": "读取文件内容",
-        "schema": {"type": "object", "properties": {"filepath": {"type": "string"}}, "required": ["filepath"]}
+        "schema": {"type": "object", "properties": {
+            "filepath": {"type": "string"},
+            "offset": {"type": "integer", "minimum": 0, "default": 0, "description": "起始字节偏移，大文件分段读取时使用上次返回的 next_offset"},
+            "length": {"type": "integer", "minimum": 1, "description": "读取字节数 (默认 256KB，最大 10MB)"}
+        }, "required": ["filepath"]}
     },
     "get_version": {
         "desc": "查看版本信息",
@@ -886,101 +1508,539 @@ TOOLS = {
     }
 }
 
-def handle(req):
-    m = req.get("method", "")
-    p = req.get("params", {})
-    rid = req.get("id")
-    
-    if m == "initialize":
-        return {"jsonrpc": "2.0", "id": rid, "result": {
-            "protocolVersion": "2024-11-05",
-            "capabilities": {"tools": {}},
-            "serverInfo": {"name": "kicad-mcp", "version": "3.4"}
-        }}
+# 未安装 FreeRouting 时不在 tools/list 中提供 auto_route
+if not FREEROUTING_AVAILABLE:
+    del TOOLS["auto_route"]
+
+# 慢工具默认提交到线程池异步执行，快工具直接在读循环中执行
+SLOW_TOOLS = frozenset({
+    "run_drc", "run_erc", "fill_zones",
+    "export_gerber", "export_bom", "export_netlist", "export_3d", "export_svg", "export_pdf",
+    "export_sch_pdf", "export_sch_svg", "export_step", "export_jlcpcb", "export_all"
+})
+
+for n in SLOW_TOOLS:
+    TOOLS[n]["schema"]["properties"]["async_mode"] = {
+        "type": "boolean", "default": True,
+        "description": "异步模式: 立即返回 task_id，用 get_task_status 获取结果"
+    }
+
+# 只读工具: 并发的相同调用合并为一次执行
+READ_ONLY_TOOLS = frozenset({"list_projects", "get_board_info", "list_tasks", "get_output_files", "get_version"})
+
+SCHEMA_TYPES = {"string": str, "integer": int, "boolean": bool, "object": dict}
+
+if HAS_FASTJSONSCHEMA:
+    SchemaError = fastjsonschema.JsonSchemaException
+else:
+    SchemaError = ValueError
+
+def compile_validator(schema):
+    """把工具的 inputSchema 编译成校验函数，返回补全默认值后的参数"""
+    if HAS_FASTJSONSCHEMA:
+        return fastjsonschema.compile(schema)
+    
+    # 简易校验: 只覆盖 TOOLS 中用到的 required / type / enum / minimum / default
+    required = tuple(sys.intern(k) for k in schema.get("required", ()))
+    props = tuple((sys.intern(k), v.get("type"), v.get("enum"), v.get("minimum"))
+                  for k, v in schema.get("properties", {}).items())
+    defaults = tuple((sys.intern(k), v["default"])
+                     for k, v in schema.get("properties", {}).items() if "default" in v)
+    
+    def validate(a):
+        if not isinstance(a, dict):
+            raise SchemaError("data must be object")
+        for k in required:
+            if k not in a:
+                raise SchemaError(f"data must contain ['{k}'] properties")
+        for k, tname, enum, minimum in props:
+            if k not in a:
+                continue
+            v = a[k]
+            typ = SCHEMA_TYPES.get(tname)
+            if typ and (not isinstance(v, typ) or (typ is int and isinstance(v, bool))):
+                raise SchemaError(f"data.{k} must be {tname}")
+            if enum and v not in enum:
+                raise SchemaError(f"data.{k} must be one of {enum}")
+            if minimum is not None and v < minimum:
+                raise SchemaError(f"data.{k} must be bigger than or equal to {minimum}")
+        # 与 fastjsonschema 一致，补全缺省参数
+        for k, v in defaults:
+            if k not in a:
+                a[k] = v
+        return a
+    return validate
+
+for t in TOOLS.values():
+    t["validator"] = compile_validator(t["schema"])
+
+# 构建完成后冻结，工具名驻留以便查找时走同一对象比较
+TOOLS = types.MappingProxyType({sys.intern(n): t for n, t in TOOLS.items()})
+
+# TOOLS 是静态的，tools/list 结果导入时构建一次
+_TOOLS_LIST = [{"name": n, "description": t["desc"], "inputSchema": t["schema"]} for n, t in TOOLS.items()]
+# 每个工具条目只序列化一次，响应时直接拼接字节
+_TOOL_ENTRIES_JSON = [json_bytes(entry) for entry in _TOOLS_LIST]
+_TOOLS_LIST_JSON = b'{"tools":[' + b",".join(_TOOL_ENTRIES_JSON) + b"]}"
+
+TOOL_HANDLERS = {
+    "list_projects": lambda a: tool_list_projects(),
+    "run_drc": lambda a: tool_run_drc(a["project"]),
+    "run_erc": lambda a: tool_run_erc(a["project"]),
+    "fill_zones": lambda a: tool_fill_zones(a["project"]),
+    "auto_route": lambda a: tool_auto_route(a["project"], a.get("max_passes", 100), a.get("async_mode", True)),
+    "get_task_status": lambda a: tool_get_task_status(a["task_id"]),
+    "cancel_task": lambda a: tool_cancel_task(a["task_id"]),
+    "list_tasks": lambda a: tool_list_tasks(),
+    "get_board_info": lambda a: tool_get_board_info(a["project"]),
+    "export_gerber": lambda a: tool_export_gerber(a["project"]),
+    "export_bom": lambda a: tool_export_bom(a["project"]),
+    "export_netlist": lambda a: tool_export_netlist(a["project"], a.get("format", "kicadxml")),
+    "export_3d": lambda a: tool_export_3d(a["project"], a.get("view", "top")),
+    "export_svg": lambda a: tool_export_svg(a["project"], a.get("view", "all")),
+    "export_pdf": lambda a: tool_export_pdf(a["project"], a.get("layers", "all")),
+    "export_sch_pdf": lambda a: tool_export_sch_pdf(a["project"]),
+    "export_sch_svg": lambda a: tool_export_sch_svg(a["project"]),
+    "export_step": lambda a: tool_export_step(a["project"]),
+    "export_jlcpcb": lambda a: tool_export_jlcpcb(a["project"]),
+    "export_all": lambda a: tool_export_all(a["project"]),
+    "get_output_files": lambda a: tool_get_files(a["project"]),
+    "read_file": lambda a: tool_read_file(a["filepath"], a.get("offset", 0), a.get("length")),
+    "get_version": lambda a: tool_version()
+}
+
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+# 文件类只读工具的短时结果缓存，同时以项目目录 mtime 校验
+RESULT_CACHE_TTL = 1.0
+CACHED_TOOLS = frozenset({"get_board_info", "get_output_files"})
+_RESULT_CACHE = {}
+# 会改动项目文件的工具，同步执行完后清空结果缓存
+MUTATING_TOOLS = SLOW_TOOLS | {"auto_route"}
+
+def call_key(n, a):
+    # 参数值可能是 list/dict 等不可哈希类型，序列化后作为键
+    return (n, json_bytes(sorted(a.items())))
+
+def call_coalesced(n, a):
+    """相同工具+参数正在执行时，等待并共享那次调用的结果"""
+    key = call_key(n, a)
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(key)
+        owner = future is None
+        if owner:
+            future = _INFLIGHT[key] = Future()
+    if not owner:
+        return future.result()
     
-    if m == "notifications/initialized":
+    try:
+        r = TOOL_HANDLERS[n](a)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(r)
+        return r
+    finally:
+        with _INFLIGHT_LOCK:
+            del _INFLIGHT[key]
+
+def call_cached(n, a):
+    key = call_key(n, a)
+    try:
+        mtime = os.stat(os.path.join(PROJECTS_BASE, a["project"])).st_mtime_ns
+    except OSError:
+        mtime = None
+    now = time.monotonic()
+    hit = _RESULT_CACHE.get(key)
+    if hit and hit[0] > now and hit[1] == mtime:
+        return hit[2]
+    
+    r = call_coalesced(n, a)
+    if mtime is not None and "error" not in r:
+        _RESULT_CACHE[key] = (now + RESULT_CACHE_TTL, mtime, r)
+    return r
+
+# 导出结果按内容寻址缓存: 设计文件内容和参数都没变，且输出文件仍是当时写出的那份时直接返回。
+# 输出写在固定的 output/ 路径，会被其他版本/参数的导出覆盖，所以记录中保存每个输出文件的
+# (mtime_ns, size)，命中时逐个核对。export_all 还包含 DRC/ERC 等汇总结果，不缓存。
+EXPORT_CACHE_DIR = os.path.join(TASKS_DIR, "cache")
+EXPORT_TOOLS = frozenset({
+    "export_gerber", "export_bom", "export_netlist", "export_3d", "export_svg", "export_pdf",
+    "export_sch_pdf", "export_sch_svg", "export_step", "export_jlcpcb"
+})
+# 影响导出结果的设计文件: 板子、所有 (层次) 原理图、项目设置和设计规则
+DESIGN_EXTS = (".kicad_pcb", ".kicad_sch", ".kicad_pro", ".kicad_dru")
+_FILE_DIGESTS = {}
+
+def file_digest(path):
+    """文件内容的 blake2b，按 (mtime_ns, size) 记忆，文件不变时不重复读取"""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _FILE_DIGESTS.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _FILE_DIGESTS[path] = (stamp, digest)
+    return digest
+
+def design_files(d):
+    """项目中的设计文件 (含子目录里的子原理图)，跳过 output/、隐藏目录和自动保存文件"""
+    files = []
+    for root, dirs, names in os.walk(d):
+        dirs[:] = [x for x in dirs if not x.startswith('.') and not (root == d and x == "output")]
+        files.extend(os.path.join(root, n) for n in names
+                     if n.endswith(DESIGN_EXTS) and not n.startswith("_autosave-"))
+    return sorted(files)
+
+def export_cache_key(n, a):
+    d = os.path.join(PROJECTS_BASE, a["project"])
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json_bytes([n, sorted([k, v] for k, v in a.items() if k != "async_mode")]))
+    for f in design_files(d):
+        h.update(os.path.relpath(f, d).encode())
+        h.update(file_digest(f).encode())
+    return h.hexdigest()
+
+def abs_paths(obj):
+    """结果中引用的绝对路径 (file/dir/files 等)"""
+    if isinstance(obj, str):
+        if os.path.isabs(obj):
+            yield obj
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            yield from abs_paths(v)
+    elif isinstance(obj, list):
+        for v in obj:
+            yield from abs_paths(v)
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
         return None
+    return [st.st_mtime_ns, st.st_size]
+
+def output_stamps(r):
+    """结果引用的输出文件 (目录则取其中所有文件) 当前的 (mtime_ns, size)"""
+    stamps = {}
+    for p in abs_paths(r):
+        if os.path.isdir(p):
+            for e in iter_files(p):
+                st = e.stat()
+                stamps[e.path] = [st.st_mtime_ns, st.st_size]
+        elif (stamp := file_stamp(p)) is not None:
+            stamps[p] = stamp
+    return stamps
+
+def load_export_cache(key):
+    try:
+        with open(os.path.join(EXPORT_CACHE_DIR, f"{key}.json"), 'rb') as f:
+            record = json_loads(f.read())
+        r, outputs = record["result"], record["outputs"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    # 输出文件被删除或被其他导出覆盖过就重新导出
+    if not outputs or any(file_stamp(p) != stamp for p, stamp in outputs.items()):
+        return None
+    r["cached"] = True
+    return r
+
+def save_export_cache(key, r):
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_CACHE_DIR, f"{key}.json")
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, 'wb') as f:
+        f.write(json_bytes({"result": r, "outputs": output_stamps(r)}))
+    os.replace(tmp, path)
+
+def fully_succeeded(r):
+    """结果成功且每个子结果 (export_3d/svg 的视图、export_jlcpcb 的各部分) 都成功"""
+    if "error" in r or not r.get("success", True):
+        return False
+    return all(v.get("success") if isinstance(v, dict) else v for v in r.get("results", {}).values())
+
+def run_tool(n, a):
+    """执行工具 (协程工具在当前线程跑完)，导出工具先查内容寻址缓存"""
+    key = export_cache_key(n, a) if n in EXPORT_TOOLS else None
+    if key:
+        r = load_export_cache(key)
+        if r:
+            logger.debug("导出缓存命中: %s %s", n, key)
+            return r
+    
+    r = TOOL_HANDLERS[n](a)
+    if asyncio.iscoroutine(r):
+        r = asyncio.run(r)
+    
+    # 只缓存完全成功的结果，部分失败下次要重试
+    if key and fully_succeeded(r):
+        save_export_cache(key, r)
+    return r
+
+def run_tool_task(task_id, n, a):
+    """线程池 worker: 执行慢工具并把结果写入任务 journal"""
+    update_task(task_id, status="started")
+    try:
+        r = run_tool(n, a)
+        ok = "error" not in r and r.get("success", True)
+        update_task(task_id, status="completed" if ok else "failed", result=r)
+    except Exception as e:
+        logger.error("任务 %s 错误: %s", task_id, e)
+        update_task(task_id, status="failed", error=str(e))
+    finally:
+        # 导出/填充会改动项目文件
+        _RESULT_CACHE.clear()
+        compact_tasks()
+
+def submit_tool_task(n, a):
+    project = a.get("project", "")
+    task_id = f"{n}_{project}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+    # pid 记录为服务进程，服务退出后 check_worker 会把未完成的任务标记为失败
+    save_task(task_id, {
+        "id": task_id,
+        "type": n,
+        "project": project,
+        "status": "queued",
+        "pid": os.getpid()
+    })
+    future = _TOOL_POOL.submit(run_tool_task, task_id, n, a)
+    _TOOL_FUTURES[task_id] = future
+    future.add_done_callback(lambda f: _TOOL_FUTURES.pop(task_id, None))
+    return {
+        "success": True,
+        "async": True,
+        "task_id": task_id,
+        "message": f"{n} 已提交，使用 get_task_status 查询结果"
+    }
+
+def ok_response(rid, result_json):
+    """成功响应信封，result_json 是已序列化的 result 字节"""
+    return b'{"jsonrpc":"2.0","id":' + json_bytes(rid) + b',"result":' + result_json + b'}'
+
+def error_response(rid, code, message):
+    return (b'{"jsonrpc":"2.0","id":' + json_bytes(rid) + b',"error":{"code":' + str(code).encode()
+            + b',"message":' + json_bytes(message) + b'}}')
+
+def text_result(r):
+    """tools/call 的 result: 工具返回值序列化后作为 text 内容"""
+    return b'{"content":[{"type":"text","text":' + json_bytes(json_bytes(r).decode()) + b'}]}'
+
+_INITIALIZE_RESULT = json_bytes({
+    "protocolVersion": "2024-11-05",
+    "capabilities": {"tools": {}},
+    "serverInfo": {"name": "kicad-mcp", "version": "3.4"}
+})
+_VERSION_RESULT = [None]
+
+def handle_initialize(rid, p):
+    return ok_response(rid, _INITIALIZE_RESULT)
+
+def handle_tools_list(rid, p):
+    return ok_response(rid, _TOOLS_LIST_JSON)
+
+def handle_tools_call(rid, p):
+    n = p.get("name", "")
+    t = TOOLS.get(n)
+    if t is None:
+        logger.warning("未知工具: %s", n)
+        return ok_response(rid, text_result({"error": f"未知工具: {n}"}))
+    
+    a = p.get("arguments", {})
+    logger.debug("调用: %s, 参数: %s", n, a)
+    try:
+        a = t["validator"](a)
+    except SchemaError as e:
+        return error_response(rid, -32602, f"Invalid params: {e}")
     
-    if m == "tools/list":
-        tools = [{"name": n, "description": t["desc"], "inputSchema": t["schema"]} for n, t in TOOLS.items()]
-        return {"jsonrpc": "2.0", "id": rid, "result": {"tools": tools}}
-    
-    if m == "tools/call":
-        n = p.get("name", "")
-        a = p.get("arguments", {})
-        log(f"调用: {n}, 参数: {a}")
+    try:
+        if n == "get_version":
+            if _VERSION_RESULT[0] is None:
+                _VERSION_RESULT[0] = text_result(tool_version())
+            return ok_response(rid, _VERSION_RESULT[0])
         
+        if n in SLOW_TOOLS and a.get("async_mode", True):
+            r = submit_tool_task(n, a)
+        elif n in CACHED_TOOLS:
+            r = call_cached(n, a)
+        elif n in READ_ONLY_TOOLS:
+            r = call_coalesced(n, a)
+        else:
+            r = run_tool(n, a)
+            if n in MUTATING_TOOLS:
+                _RESULT_CACHE.clear()
+        
+        return ok_response(rid, text_result(r))
+    except FileNotFoundError as e:
+        return error_response(rid, -32001, str(e))
+    except Exception as e:
+        logger.error("错误: %s", e)
+        return error_response(rid, -32000, str(e))
+
+METHOD_HANDLERS = {
+    "initialize": handle_initialize,
+    "notifications/initialized": lambda rid, p: None,
+    "tools/list": handle_tools_list,
+    "tools/call": handle_tools_call
+}
+
+_KNOWN_METHODS = frozenset(METHOD_HANDLERS)
+
+def handle(req):
+    m = req.get("method", "")
+    # 未知方法直接拒绝，不再读取 params；method 可能是列表等不可哈希的值
+    if not isinstance(m, str) or m not in _KNOWN_METHODS:
+        return error_response(req.get("id"), -32601, f"Unknown: {m}")
+    return METHOD_HANDLERS[m](req.get("id"), req.get("params", {}))
+
+STDIN_CHUNK = 65536
+STDOUT_FLUSH = 65536
+REQUEST_WORKERS = 4
+REQUEST_QUEUE_SIZE = 64
+MAX_LINE = 4 * 1024 * 1024
+
+# 请求流水线: 读线程解析后提交到此线程池，写线程按到达顺序输出
+_REQUEST_POOL = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="request")
+
+def handle_message(obj):
+    """处理单个请求或 JSON-RPC 批量数组，返回要写出的字节，通知返回 None"""
+    if not isinstance(obj, list):
+        return handle(obj)
+    
+    if not obj:
+        return error_response(None, -32600, "Invalid Request")
+    parts = []
+    for req in obj:
+        # 批量中每个非对象元素都要回复 Invalid Request
+        if not isinstance(req, dict):
+            parts.append(error_response(None, -32600, "Invalid Request"))
+            continue
         try:
-            if n == "list_projects":
-                r = tool_list_projects()
-            elif n == "run_drc":
-                r = tool_run_drc(a["project"])
-            elif n == "run_erc":
-                r = tool_run_erc(a["project"])
-            elif n == "fill_zones":
-                r = tool_fill_zones(a["project"])
-            elif n == "auto_route":
-                r = tool_auto_route(a["project"], a.get("max_passes", 100), a.get("async_mode", True))
-            elif n == "get_task_status":
-                r = tool_get_task_status(a["task_id"])
-            elif n == "list_tasks":
-                r = tool_list_tasks()
-            elif n == "get_board_info":
-                r = tool_get_board_info(a["project"])
-            elif n == "export_gerber":
-                r = tool_export_gerber(a["project"])
-            elif n == "export_bom":
-                r = tool_export_bom(a["project"])
-            elif n == "export_netlist":
-                r = tool_export_netlist(a["project"], a.get("format", "kicadxml"))
-            elif n == "export_3d":
-                r = tool_export_3d(a["project"], a.get("view", "top"))
-            elif n == "export_svg":
-                r = tool_export_svg(a["project"], a.get("view", "all"))
-            elif n == "export_pdf":
-                r = tool_export_pdf(a["project"], a.get("layers", "all"))
-            elif n == "export_sch_pdf":
-                r = tool_export_sch_pdf(a["project"])
-            elif n == "export_sch_svg":
-                r = tool_export_sch_svg(a["project"])
-            elif n == "export_step":
-                r = tool_export_step(a["project"])
-            elif n == "export_jlcpcb":
-                r = tool_export_jlcpcb(a["project"])
-            elif n == "export_all":
-                r = tool_export_all(a["project"])
-            elif n == "get_output_files":
-                r = tool_get_files(a["project"])
-            elif n == "read_file":
-                r = tool_read_file(a["filepath"])
-            elif n == "get_version":
-                r = tool_version()
-            else:
-                r = {"error": f"未知工具: {n}"}
-            
-            return {"jsonrpc": "2.0", "id": rid, "result": {
-                "content": [{"type": "text", "text": json.dumps(r, ensure_ascii=False, indent=2)}]
-            }}
+            r = handle(req)
         except Exception as e:
-            log(f"错误: {e}")
-            return {"jsonrpc": "2.0", "id": rid, "error": {"code": -32000, "message": str(e)}}
-    
-    return {"jsonrpc": "2.0", "id": rid, "error": {"code": -32601, "message": f"Unknown: {m}"}}
-
-def main():
-    log("KiCad MCP Server v3.4 启动 (KiCad 9.x)")
-    log(f"pcbnew API: {'可用' if HAS_PCBNEW else '不可用'}")
-    log(f"FreeRouting: {'可用' if os.path.exists(FREEROUTING_JAR) else '不可用'}")
-    log(f"异步任务目录: {TASKS_DIR}")
-    for line in sys.stdin:
-        if not line.strip():
+            logger.error("处理错误: %s", e)
             continue
+        if r:
+            parts.append(r)
+    return b"[" + b",".join(parts) + b"]" if parts else None
+
+def write_responses(q, out):
+    """写线程: 按请求到达顺序取结果，下一个结果还没好时才 flush"""
+    pending = bytearray()
+    while True:
+        future = q.get()
+        if future is None:
+            break
         try:
-            r = handle(json.loads(line))
-            if r:
-                print(json.dumps(r), flush=True)
+            r = future.result()
         except Exception as e:
-            log(f"处理错误: {e}")
+            logger.error("处理错误: %s", e)
+            r = None
+        if r:
+            pending += r
+            pending += b"\n"
+        # 只有本线程消费队列，窥视队首是安全的
+        nxt = q.queue[0] if q.queue else None
+        if pending and (nxt is None or not nxt.done() or len(pending) >= STDOUT_FLUSH):
+            out.write(pending)
+            out.flush()
+            pending.clear()
+    if pending:
+        out.write(pending)
+        out.flush()
+
+def parse_error(message):
+    """解析失败的请求也要按到达顺序回复，包装成已完成的 Future 放入写队列"""
+    future = Future()
+    future.set_result(error_response(None, -32700, f"Parse error: {message}"))
+    return future
+
+def serve(fd, out):
+    """按行读取二进制 stdin，请求交给线程池并发处理，响应由写线程按序输出"""
+    q = queue.Queue(REQUEST_QUEUE_SIZE)
+    writer = threading.Thread(target=write_responses, args=(q, out), name="writer")
+    writer.start()
+    
+    try:
+        buf = bytearray()
+        pos = 0
+        eof = False
+        skipping = False  # 正在丢弃超长行的剩余部分
+        while True:
+            nl = buf.find(b"\n", pos)
+            if nl < 0 and not eof:
+                if len(buf) - pos > MAX_LINE:
+                    # 超长行不再缓存，回复一次错误后丢弃到下一个换行
+                    if not skipping:
+                        logger.warning("请求超过 %d 字节，已丢弃", MAX_LINE)
+                        q.put(parse_error("request too large"))
+                        skipping = True
+                    buf.clear()
+                else:
+                    del buf[:pos]
+                pos = 0
+                chunk = os.read(fd, STDIN_CHUNK)
+                if chunk:
+                    buf += chunk
+                else:
+                    eof = True
+                continue
+            if nl < 0:
+                if pos >= len(buf):
+                    break
+                nl = len(buf)
+            line = bytes(buf[pos:nl]).strip()
+            pos = nl + 1
+            if skipping:
+                skipping = False
+                continue
+            if not line:
+                continue
+            if len(line) > MAX_LINE:
+                logger.warning("请求超过 %d 字节，已丢弃", MAX_LINE)
+                q.put(parse_error("request too large"))
+                continue
+            # 只有对象或数组才可能是合法请求，其他输入不进解析器
+            if line[:1] not in (b"{", b"["):
+                q.put(parse_error("expected object or array"))
+                continue
+            try:
+                obj = json_loads(line)
+            except Exception as e:
+                # 标准库 json 遇到过深的嵌套会抛 RecursionError，不是 ValueError
+                logger.error("处理错误: %s", e)
+                q.put(parse_error("invalid JSON"))
+                continue
+            q.put(_REQUEST_POOL.submit(handle_message, obj))
+    finally:
+        # 读循环出任何意外都要让写线程收到结束标记，否则进程无法退出
+        q.put(None)
+        writer.join()
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--run-task":
+        run_route_task(sys.argv[2])
+        return
+    logging.basicConfig(stream=sys.stderr, format="[MCP] %(message)s")
+    # getLevelName 对已知级别名返回数值，未知的返回 "Level XXX" 字符串
+    level = logging.getLevelName(LOG_LEVEL)
+    if isinstance(level, int):
+        logger.setLevel(level)
+    else:
+        logger.setLevel(logging.INFO)
+        logger.warning("未知日志级别 KICAD_MCP_LOG_LEVEL=%s，改用 INFO", LOG_LEVEL)
+    logger.info("KiCad MCP Server v3.4 启动 (KiCad 9.x)")
+    logger.info("pcbnew API: %s", "可用" if HAS_PCBNEW else "不可用")
+    logger.info("FreeRouting: %s", "可用" if FREEROUTING_AVAILABLE else "不可用 (不提供 auto_route)")
+    logger.info("异步任务目录: %s", TASKS_DIR)
+    logger.info("项目目录监听: %s", "已启用" if watch_projects() else "未启用 (按 mtime 校验)")
+    _VERSION_INFO[0] = _TOOL_POOL.submit(version_info)
+    serve(sys.stdin.fileno(), sys.stdout.buffer)
 
 if __name__ == "__main__":
     main()